@@ -2,140 +2,95 @@ import pandas as pd
 import streamlit as st
 import numpy as np
 import zipfile
-import os
+import io
+import posixpath
 from lxml import etree
-import tempfile
-from openpyxl import load_workbook
-from openpyxl.drawing.spreadsheet_drawing import SpreadsheetDrawing, AnchorMarker
-from openpyxl.drawing.image import Image
-from openpyxl.drawing.xdr import XDRPoint2D, XDRPositiveSize2D
-
-def _get_anchor_coordinates(anchor):
-    """アンカー情報から座標を取得する共通関数"""
-    try:
-        if hasattr(anchor, 'to'):
-            # Two cell anchor type
-            from_marker = anchor._from if hasattr(anchor, '_from') else anchor.from_marker
-            to_marker = anchor.to if hasattr(anchor, 'to') else anchor.to_marker
-            
-            col = getattr(from_marker, 'col', 0) or 0
-            row = getattr(from_marker, 'row', 0) or 0
-            
-            # サイズの計算
-            width = (getattr(to_marker, 'col', col) or col) - col
-            height = (getattr(to_marker, 'row', row) or row) - row
-            
-            return col, row, width, height
-        else:
-            # One cell anchor type
-            col = getattr(anchor, 'col', 0) or 0
-            row = getattr(anchor, 'row', 0) or 0
-            width = getattr(anchor, 'width', None)
-            height = getattr(anchor, 'height', None)
-            
-            return col, row, width, height
-    except Exception as e:
-        st.warning(f"アンカー座標の取得中にエラー: {str(e)}")
-        return 0, 0, None, None
+import logging
 
-def _process_drawing(drawing, shape_type='unknown'):
-    """描画オブジェクトの処理"""
-    try:
-        anchor = getattr(drawing, '_anchor', None) or getattr(drawing, 'anchor', None)
-        if not anchor:
-            return None
+logger = logging.getLogger(__name__)
 
-        col, row, width, height = _get_anchor_coordinates(anchor)
-        
-        shape_info = {
-            'type': shape_type,
-            'x': col,
-            'y': row,
-            'width': width,
-            'height': height,
-            'text': getattr(drawing, 'text', '')
-        }
+# DrawingMLの名前空間（ファイルごとのnsmapに依存しないよう固定で持つ）
+_DRAWING_NAMESPACES = {
+    'xdr': 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+}
+
+def _shape_from_anchor(anchor):
+    """twoCellAnchor要素から図形情報の辞書を作成する"""
+    from_elem = anchor.find('xdr:from', _DRAWING_NAMESPACES)
+    to_elem = anchor.find('xdr:to', _DRAWING_NAMESPACES)
+    if from_elem is None or to_elem is None:
+        return None
+    
+    x = int(from_elem.findtext('xdr:col', namespaces=_DRAWING_NAMESPACES))
+    y = int(from_elem.findtext('xdr:row', namespaces=_DRAWING_NAMESPACES))
+    
+    # 図形の種類を判定
+    shape_type = 'unknown'
+    if anchor.find('.//xdr:pic', _DRAWING_NAMESPACES) is not None:
+        shape_type = 'image'
+    elif anchor.find('.//xdr:sp', _DRAWING_NAMESPACES) is not None:
+        shape_type = 'shape'
+    
+    shape_info = {
+        'type': shape_type,
+        'x': x,
+        'y': y,
+        'width': int(to_elem.findtext('xdr:col', namespaces=_DRAWING_NAMESPACES)) - x,
+        'height': int(to_elem.findtext('xdr:row', namespaces=_DRAWING_NAMESPACES)) - y
+    }
+    
+    # テキスト情報の取得（存在する場合）
+    text_elem = anchor.find('.//xdr:txBody//a:t', _DRAWING_NAMESPACES)
+    if text_elem is not None:
+        shape_info['text'] = text_elem.text
+    
+    return shape_info
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _drawing_shapes(wb_data):
+    """
+    drawing*.xmlから図形情報を抽出する
+    (アップロードのたびに一時ファイルのパスが変わるため、ファイルの内容をキーにキャッシュ)
+    """
+    shapes_info = []
+    
+    # ExcelファイルをZIPとして開き、drawing*.xmlだけを展開せずに直接読み込む
+    with zipfile.ZipFile(io.BytesIO(wb_data), 'r') as zip_ref:
+        drawing_names = [
+            name for name in zip_ref.namelist()
+            if posixpath.dirname(name) == 'xl/drawings'
+            and posixpath.basename(name).startswith('drawing') and name.endswith('.xml')
+        ]
         
-        # 図形タイプの詳細情報を取得
-        if hasattr(drawing, 'style'):
-            shape_info['style'] = drawing.style
-        if hasattr(drawing, '_type'):
-            shape_info['shape_type'] = drawing._type
-        elif hasattr(drawing, 'type'):
-            shape_info['shape_type'] = drawing.type
+        for drawing_name in drawing_names:
+            # XMLファイルを解析
+            with zip_ref.open(drawing_name) as drawing_file:
+                root = etree.parse(drawing_file).getroot()
             
-        return shape_info
-    except Exception as e:
-        st.warning(f"描画オブジェクトの処理中にエラー: {str(e)}")
-        return None
+            # 図形情報の抽出
+            for shape in root.iterfind('.//xdr:twoCellAnchor', namespaces=_DRAWING_NAMESPACES):
+                try:
+                    shape_info = _shape_from_anchor(shape)
+                    if shape_info is not None:
+                        shapes_info.append(shape_info)
+                        logger.debug("図形を検出: %s at (%s, %s)", shape_info['type'], shape_info['x'], shape_info['y'])
+                except Exception as e:
+                    st.warning(f"図形の解析中にエラー: {str(e)}")
+                    continue
+    
+    return tuple(shapes_info)
 
 def extract_shape_info(wb_path, sheet_name):
     st.write(f"図形情報の抽出を開始... シート名: {sheet_name}")
     shapes_info = []
     
     try:
-        # 一時ディレクトリの作成
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # ExcelファイルをZIPとして解凍
-            with zipfile.ZipFile(wb_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-            
-            # drawings フォルダのパス
-            drawings_dir = os.path.join(temp_dir, 'xl', 'drawings')
-            
-            # drawing*.xmlファイルを検索
-            if os.path.exists(drawings_dir):
-                for file in os.listdir(drawings_dir):
-                    if file.startswith('drawing') and file.endswith('.xml'):
-                        drawing_path = os.path.join(drawings_dir, file)
-                        
-                        # XMLファイルを解析
-                        tree = etree.parse(drawing_path)
-                        root = tree.getroot()
-                        
-                        # 名前空間の取得
-                        nsmap = root.nsmap
-                        
-                        # 図形情報の抽出
-                        for shape in root.findall('.//xdr:twoCellAnchor', namespaces=nsmap):
-                            try:
-                                # 位置情報の取得
-                                from_elem = shape.find('.//xdr:from', namespaces=nsmap)
-                                to_elem = shape.find('.//xdr:to', namespaces=nsmap)
-                                
-                                if from_elem is not None and to_elem is not None:
-                                    x = int(from_elem.find('.//xdr:col', namespaces=nsmap).text)
-                                    y = int(from_elem.find('.//xdr:row', namespaces=nsmap).text)
-                                    
-                                    # 図形の種類を判定
-                                    shape_type = 'unknown'
-                                    if shape.find('.//xdr:pic', namespaces=nsmap) is not None:
-                                        shape_type = 'image'
-                                    elif shape.find('.//xdr:sp', namespaces=nsmap) is not None:
-                                        shape_type = 'shape'
-                                    
-                                    # 図形情報の保存
-                                    shape_info = {
-                                        'type': shape_type,
-                                        'x': x,
-                                        'y': y,
-                                        'width': int(to_elem.find('.//xdr:col', namespaces=nsmap).text) - x,
-                                        'height': int(to_elem.find('.//xdr:row', namespaces=nsmap).text) - y
-                                    }
-                                    
-                                    # テキスト情報の取得（存在する場合）
-                                    text_elem = shape.find('.//xdr:txBody//a:t', namespaces=nsmap)
-                                    if text_elem is not None:
-                                        shape_info['text'] = text_elem.text
-                                    
-                                    shapes_info.append(shape_info)
-                                    st.write(f"図形を検出: {shape_type} at ({x}, {y})")
-                            except Exception as e:
-                                st.warning(f"図形の解析中にエラー: {str(e)}")
-                                continue
-                
-            st.write(f"検出された図形の総数: {len(shapes_info)}")
-            
+        with open(wb_path, 'rb') as wb_file:
+            shapes_info = list(_drawing_shapes(wb_file.read()))
+        
+        st.write(f"検出された図形の総数: {len(shapes_info)}")
+        
     except Exception as e:
         st.error(f"図形検出中にエラーが発生: {str(e)}")
     
@@ -144,67 +99,411 @@ def extract_shape_info(wb_path, sheet_name):
 def compare_shapes(shapes1, shapes2):
     differences = []
     
+    # (x, y, type) ごとに図形の位置を並び順で保持する（同じ位置に重なった図形は出現順に対応付ける）
+    keys1 = [(shape['x'], shape['y'], shape['type']) for shape in shapes1]
+    keys2 = [(shape['x'], shape['y'], shape['type']) for shape in shapes2]
+    indices1 = {}
+    for idx1, key1 in enumerate(keys1):
+        indices1.setdefault(key1, []).append(idx1)
+    key_counts2 = {}
+    
     # Find added and modified shapes
-    for idx2, shape2 in enumerate(shapes2):
-        found_match = False
-        for idx1, shape1 in enumerate(shapes1):
-            if (shape1['x'] == shape2['x'] and 
-                shape1['y'] == shape2['y'] and 
-                shape1['type'] == shape2['type']):
-                found_match = True
-                # Check for modifications
-                if (shape1.get('width') != shape2.get('width') or 
-                    shape1.get('height') != shape2.get('height') or 
-                    shape1.get('text') != shape2.get('text')):
-                    differences.append({
-                        'type': '変更',
-                        'shape_index': idx2,
-                        'old_shape': shape1,
-                        'new_shape': shape2
-                    })
-                break
-        
-        if not found_match:
+    for idx2, (shape2, key2) in enumerate(zip(shapes2, keys2)):
+        occurrence = key_counts2.get(key2, 0)
+        key_counts2[key2] = occurrence + 1
+        candidates = indices1.get(key2, ())
+        if occurrence >= len(candidates):
             differences.append({
                 'type': '追加',
                 'shape_index': idx2,
                 'shape': shape2
             })
-    
-    # Find deleted shapes
-    for idx1, shape1 in enumerate(shapes1):
-        found_match = False
-        for shape2 in shapes2:
-            if (shape1['x'] == shape2['x'] and 
-                shape1['y'] == shape2['y'] and 
-                shape1['type'] == shape2['type']):
-                found_match = True
-                break
+            continue
         
-        if not found_match:
+        # Check for modifications
+        shape1 = shapes1[candidates[occurrence]]
+        if (shape1.get('width') != shape2.get('width') or 
+            shape1.get('height') != shape2.get('height') or 
+            shape1.get('text') != shape2.get('text')):
             differences.append({
-                'type': '削除',
-                'shape_index': idx1,
-                'shape': shape1
+                'type': '変更',
+                'shape_index': idx2,
+                'old_shape': shape1,
+                'new_shape': shape2
             })
     
+    # Find deleted shapes（同じ位置の図形が変更後に足りない分を削除とする）
+    deleted_indices = sorted(
+        idx1 for key1, positions in indices1.items() for idx1 in positions[key_counts2.get(key1, 0):])
+    for idx1 in deleted_indices:
+        differences.append({
+            'type': '削除',
+            'shape_index': idx1,
+            'shape': shapes1[idx1]
+        })
+    
     return differences
 
+# セルスタイルのコード（0はスタイルなし）とAgGridのクラス名の対応
+_STYLE_MODIFIED, _STYLE_ADDED, _STYLE_DELETED = 1, 2, 3
+_STYLE_CELL_CLASSES = np.array(['', 'ag-cell-modified', 'ag-cell-added', 'ag-cell-deleted'], dtype=object)
+
+def _styles_from_codes(style_codes, columns):
+    """スタイルコード配列からAgGrid用のセルスタイル一覧を生成する"""
+    rows, cols = np.nonzero(style_codes)
+    return pd.DataFrame({
+        'field': np.asarray(columns, dtype=object)[cols],
+        'rowIndex': rows,
+        'cellClass': _STYLE_CELL_CLASSES[style_codes[rows, cols]]
+    }).to_dict('records')
+
+def _normalize_cell_values(frame):
+    """セル値を比較用の文字列配列（2次元）に変換する（欠損値は空文字、前後の空白は除去）"""
+    values = frame.astype(object)
+    text = values.astype(str).apply(lambda s: s.str.strip())
+    return text.where(values.notna(), '').to_numpy(dtype=object)
+
+def _shared_kind(values1, values2):
+    """2つの列の値の種類（infer_dtype）が同じならその種類を、異なればNoneを返す"""
+    kind = pd.api.types.infer_dtype(values1, skipna=True)
+    return kind if pd.api.types.infer_dtype(values2, skipna=True) == kind else None
+
+def _identical_values(values1, values2):
+    """欠損位置と値が完全に一致するかを判定する（文字列のみ・整数のみの列向け）"""
+    missing1, missing2 = pd.isna(values1), pd.isna(values2)
+    if (missing1 != missing2).any():
+        return False
+    return bool((values1[~missing1] == values2[~missing2]).all())
+
+def _string_changes(values1, values2):
+    """文字列のみの列を整数コード化して比較する（前後の空白除去・欠損は空文字として扱う）"""
+    codes, uniques = pd.factorize(np.concatenate([values1, values2]))
+    # 異なる文字列ごとに一度だけ正規化し、正規化後の文字列で振り直したコードを比較（コード-1の欠損値は末尾の空文字）
+    normalized = [value.strip() for value in uniques] + ['']
+    normalized_codes = pd.factorize(np.asarray(normalized, dtype=object))[0][codes]
+    return normalized_codes[:len(values1)] != normalized_codes[len(values1):]
+
+def _changed_cells(frame1, frame2):
+    """行・列を揃えた2つのデータフレームを比較し、値が異なるセルのマスクを返す"""
+    changed = np.zeros(frame1.shape, dtype=bool)
+    numeric_pos = []
+    text_pos = []
+    for i, (dtype1, dtype2) in enumerate(zip(frame1.dtypes, frame2.dtypes)):
+        # 同じ数値型の列は文字列化せずに数値のまま比較する
+        if dtype1 == dtype2 and dtype1.kind in 'iuf':
+            numeric_pos.append(i)
+        else:
+            text_pos.append(i)
+    
+    if numeric_pos:
+        values1 = frame1.iloc[:, numeric_pos].to_numpy(dtype=np.float64, na_value=np.nan)
+        values2 = frame2.iloc[:, numeric_pos].to_numpy(dtype=np.float64, na_value=np.nan)
+        missing1 = np.isnan(values1)
+        missing2 = np.isnan(values2)
+        changed[:, numeric_pos] = (missing1 != missing2) | (~missing1 & ~missing2 & (values1 != values2))
+    # 値がそのまま一致する列は省略し、文字列のみの列はコード化して比較。残りの列だけ文字列化する
+    normalize_pos = []
+    for i in text_pos:
+        values1, values2 = frame1.iloc[:, i].to_numpy(), frame2.iloc[:, i].to_numpy()
+        kind = _shared_kind(values1, values2)
+        if kind in ('string', 'integer') and _identical_values(values1, values2):
+            continue
+        if kind == 'string':
+            changed[:, i] = _string_changes(values1, values2)
+        else:
+            normalize_pos.append(i)
+    if normalize_pos:
+        changed[:, normalize_pos] = (
+            _normalize_cell_values(frame1.iloc[:, normalize_pos]) != _normalize_cell_values(frame2.iloc[:, normalize_pos])
+        )
+    return changed
+
+def _is_no_column(col_name):
+    """No.列かどうかを判定"""
+    return col_name.lower().strip() in ['no', 'no.', '番号']
+
+def _normalize_numeric(val):
+    """数値を正規化して文字列に変換"""
+    if pd.isna(val) or val is None:
+        return ''
+    try:
+        if isinstance(val, (int, np.integer)):
+            return str(int(val))
+        elif isinstance(val, float):
+            # 整数の場合は整数として扱う
+            if val.is_integer():
+                return str(int(val))
+            # 小数の場合は固定精度で表現
+            return f"{val:.6f}".rstrip('0').rstrip('.')
+        else:
+            return str(val)
+    except (AttributeError, ValueError, TypeError):
+        return str(val)
+
+def _normalize_string(val):
+    """文字列を正規化"""
+    if pd.isna(val) or val is None:
+        return ''
+    return str(val).strip().lower()
+
+# 値の型ごとの数値型判定の結果（出現する型の種類は少ないため、型ごとに一度だけ判定する）
+_NUMERIC_TYPES = {}
+
+def _is_numeric_value(val):
+    """値の型が数値型（bool・NumPyの数値型を含む）かを判定する"""
+    value_type = type(val)
+    is_numeric = _NUMERIC_TYPES.get(value_type)
+    if is_numeric is None:
+        is_numeric = _NUMERIC_TYPES[value_type] = pd.api.types.is_numeric_dtype(value_type)
+    return is_numeric
+
+def _normalize_key_value(val):
+    """キー列の値を型に応じて正規化"""
+    if _is_numeric_value(val):
+        return _normalize_numeric(val)
+    return _normalize_string(val)
+
+def _key_column_hashes(series, normalize):
+    """キー列を正規化した文字列の64bitハッシュ配列に変換する（異なる値ごとに一度だけ正規化・ハッシュ化）"""
+    codes, uniques = pd.factorize(series)
+    if series.dtype.kind in 'iu':
+        normalized = uniques.astype(str).tolist()
+    else:
+        normalized = [normalize(value) for value in uniques.to_numpy(dtype=object)]
+    # コード-1（欠損値）は末尾に追加した欠損値の正規化結果を参照する
+    normalized.append(normalize(None))
+    return pd.util.hash_array(np.asarray(normalized, dtype=object))[codes]
+
+def _row_hashes(df, key_columns):
+    """
+    Create hash values for row matching based on key columns with improved type handling
+    (キー列ごとに正規化した文字列のハッシュを求め、行ごとの64bitハッシュにまとめる)
+    """
+    # No.列以外のキー列を優先して処理
+    other_key_columns = [col for col in key_columns if not _is_no_column(col)]
+    no_columns = [col for col in key_columns if _is_no_column(col)]
+    
+    parts = [_key_column_hashes(df[col], _normalize_key_value) for col in other_key_columns]
+    # No.列は参考情報として数値の正規化のみ行う（行番号の自動更新を考慮）
+    parts += [_key_column_hashes(df[col], _normalize_numeric) for col in no_columns]
+    
+    if not parts:
+        return np.zeros(len(df), dtype=np.uint64)
+    key_frame = pd.DataFrame(dict(enumerate(parts)), index=pd.RangeIndex(len(df)))
+    return pd.util.hash_pandas_object(key_frame, index=False).to_numpy()
+
+def _string_similarity(s1, s2):
+    """文字列の類似度を計算（レーベンシュタイン距離ベース）"""
+    if not s1 and not s2:  # 両方空の場合
+        return 1.0
+    if not s1 or not s2:  # どちらかが空の場合
+        return 0.0
+        
+    # 文字列を正規化
+    s1 = str(s1).strip().lower()
+    s2 = str(s2).strip().lower()
+    
+    if s1 == s2:
+        return 1.0
+        
+    # 簡易的なレーベンシュタイン距離の計算
+    len_s1, len_s2 = len(s1), len(s2)
+    if len_s1 < len_s2:
+        s1, s2 = s2, s1
+        len_s1, len_s2 = len_s2, len_s1
+    
+    # 文字の一致度を計算
+    matches = sum(1 for i in range(min(len_s1, len_s2)) if s1[i] == s2[i])
+    return matches / max(len_s1, len_s2)
+
+def _numeric_similarity(v1, v2):
+    """数値の類似度を計算"""
+    try:
+        if pd.isna(v1) and pd.isna(v2):
+            return 1.0
+        if pd.isna(v1) or pd.isna(v2):
+            return 0.0
+        
+        n1 = float(v1)
+        n2 = float(v2)
+        
+        if n1 == n2:
+            return 1.0
+            
+        # 数値の差に基づく類似度
+        max_val = max(abs(n1), abs(n2))
+        if max_val == 0:
+            return 1.0
+            
+        diff_ratio = abs(n1 - n2) / max_val
+        return max(0, 1 - diff_ratio)
+    except (ValueError, TypeError):
+        return 0.0
+
+def _value_similarity(val1, val2):
+    """セル値の類似度を型に応じて計算"""
+    # 数値型の場合
+    if _is_numeric_value(val1) or _is_numeric_value(val2):
+        return _numeric_similarity(val1, val2)
+    # 文字列型の場合
+    return _string_similarity(val1, val2)
+
+# 類似度表を事前に作成する最大サイズ（これを超える列は行ごとに計算する）
+_SIMILARITY_TABLE_LIMIT = 1_000_000
+
+def _factorize_values(values):
+    """セル値を整数コードに変換する（型が異なる値は区別し、欠損値は型ごとに1つにまとめる）"""
+    index = {}
+    uniques = []
+    codes = np.empty(len(values), dtype=np.intp)
+    for i, val in enumerate(values):
+        key = (type(val), None) if pd.isna(val) else (type(val), val)
+        code = index.get(key)
+        if code is None:
+            code = index[key] = len(uniques)
+            uniques.append(val)
+        codes[i] = code
+    return codes, uniques
+
+# 類似度行列をまとめて計算する際の要素数の目安（df1の行をこの範囲に収まるブロックに分ける）
+_SIMILARITY_BLOCK_SIZE = 1_000_000
+
+# 文字列類似度をまとめて計算する際に、一度に比較する文字数の目安（メモリ使用量の上限）
+_STRING_BLOCK_SIZE = 4_000_000
+
+def _string_similarity_matrix(strings1, strings2):
+    """_string_similarityと同じ計算を、文字コードの配列比較で全組み合わせについて一括で行う"""
+    normalized1 = [s.strip().lower() for s in strings1]
+    normalized2 = [s.strip().lower() for s in strings2]
+    lengths1 = np.array([len(s) for s in normalized1], dtype=np.int64)
+    lengths2 = np.array([len(s) for s in normalized2], dtype=np.int64)
+    width = max(1, lengths1.max(initial=0), lengths2.max(initial=0))
+    # 固定長のUnicode配列を文字コード（uint32）の2次元配列として扱い、同じ位置の文字を比較する
+    chars1 = np.array(normalized1, dtype=f'<U{width}').view(np.uint32).reshape(len(normalized1), width)
+    chars2 = np.array(normalized2, dtype=f'<U{width}').view(np.uint32).reshape(len(normalized2), width)
+    
+    matches = np.empty((len(normalized1), len(normalized2)), dtype=np.int64)
+    block = max(1, _STRING_BLOCK_SIZE // max(1, len(normalized2) * width))
+    for start in range(0, len(normalized1), block):
+        block_chars = chars1[start:start + block, None, :]
+        matches[start:start + block] = ((block_chars == chars2[None, :, :]) & (block_chars != 0)).sum(axis=2)
+    
+    max_lengths = np.maximum(lengths1[:, None], lengths2[None, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarity = np.where(max_lengths == 0, 1.0, matches / max_lengths)
+    
+    # 空文字の判定は正規化前の値で行う（両方空なら1、どちらかが空なら0）
+    empty1 = np.array([s == '' for s in strings1], dtype=bool)
+    empty2 = np.array([s == '' for s in strings2], dtype=bool)
+    similarity[empty1[:, None] | empty2[None, :]] = 0.0
+    similarity[empty1[:, None] & empty2[None, :]] = 1.0
+    return similarity
+
+def _numeric_similarity_matrix(numbers1, numbers2):
+    """_numeric_similarityと同じ計算を、数値同士の全組み合わせについて配列演算で一括で行う"""
+    n1 = np.array([float(val) for val in numbers1], dtype=np.float64)[:, None]
+    n2 = np.array([float(val) for val in numbers2], dtype=np.float64)[None, :]
+    missing1, missing2 = np.isnan(n1), np.isnan(n2)
+    
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        # 数値の差に基づく類似度（NaNになる組み合わせは0とする）
+        max_val = np.maximum(np.abs(n1), np.abs(n2))
+        remaining = 1 - np.abs(n1 - n2) / max_val
+        similarity = np.where(remaining > 0, remaining, 0.0)
+    similarity[(n1 == n2) | (max_val == 0)] = 1.0
+    similarity[missing1 | missing2] = 0.0
+    similarity[missing1 & missing2] = 1.0
+    return similarity
+
+# 類似度の計算方法で値を分類する（0: 文字列, 1: 実数, 2: その他）
+_KIND_STRING, _KIND_REAL, _KIND_OTHER = 0, 1, 2
+
+def _similarity_kinds(values):
+    """値ごとに類似度の計算方法の分類を返す"""
+    return np.array([
+        _KIND_STRING if isinstance(val, str)
+        else _KIND_REAL if isinstance(val, (int, float, np.integer, np.floating))
+        else _KIND_OTHER
+        for val in values
+    ], dtype=np.int8).reshape(len(values))
+
+def _similarity_matrix(uniques1, uniques2):
+    """値の全組み合わせの類似度表を作成する（文字列同士・数値同士は一括計算、それ以外は値ごとに計算）"""
+    table = np.empty((len(uniques1), len(uniques2)), dtype=float)
+    kinds1 = _similarity_kinds(uniques1)
+    kinds2 = _similarity_kinds(uniques2)
+    
+    for kind, matrix in ((_KIND_STRING, _string_similarity_matrix), (_KIND_REAL, _numeric_similarity_matrix)):
+        pos1, pos2 = np.flatnonzero(kinds1 == kind), np.flatnonzero(kinds2 == kind)
+        if len(pos1) and len(pos2):
+            table[np.ix_(pos1, pos2)] = matrix([uniques1[i] for i in pos1], [uniques2[j] for j in pos2])
+    
+    # 種類の異なる値の組み合わせなどは値ごとに計算
+    for i, kind in enumerate(kinds1.tolist()):
+        other_pos2 = range(len(uniques2)) if kind == _KIND_OTHER else np.flatnonzero(kinds2 != kind).tolist()
+        for j in other_pos2:
+            table[i, j] = _value_similarity(uniques1[i], uniques2[j])
+    return table
+
+def _similarity_column(values1, values2):
+    """1列分の値をコード化し、小さい場合は値の組み合わせごとの類似度表を作成する"""
+    codes1, uniques1 = _factorize_values(values1)
+    codes2, uniques2 = _factorize_values(values2)
+    table = None
+    if len(uniques1) * len(uniques2) <= _SIMILARITY_TABLE_LIMIT:
+        table = _similarity_matrix(uniques1, uniques2)
+    return {'codes1': codes1, 'codes2': codes2, 'uniques1': uniques1, 'uniques2': uniques2, 'table': table}
+
+def _similarity_scores(column, positions):
+    """df1側のpositions番目の値それぞれと、df2側の全ての値との類似度を2次元配列で返す"""
+    codes1 = column['codes1'][positions]
+    if column['table'] is None:
+        # 類似度表が大きすぎる列は、このブロックに現れる値の分だけ計算する
+        block_codes, codes1 = np.unique(codes1, return_inverse=True)
+        table = _similarity_matrix([column['uniques1'][code] for code in block_codes], column['uniques2'])
+    else:
+        table = column['table']
+    return table[np.ix_(codes1, column['codes2'])]
+
+def _row_changes(change_type, row_indices, frame):
+    """追加・削除された行の差分を列単位でまとめてDataFrameにする（行の値はまとめて辞書化）"""
+    # 列が無い場合、to_dict('records')は空リストを返すため行数分の空辞書を用意する
+    records = frame.iloc[row_indices].to_dict('records') if len(frame.columns) else [{} for _ in row_indices]
+    return pd.DataFrame({
+        'type': change_type,
+        'row_index': row_indices,
+        'values': records
+    })
+
 def compare_dataframes(df1, df2):
     """
     Compare two dataframes and return differences with improved row matching
     """
-    # Create copies for styling
-    df1_result = df1.copy()
-    df2_result = df2.copy()
-    
-    # Initialize style information
-    df1_styles = []
-    df2_styles = []
-    differences = []
+    # 内容が完全に同じ場合（再読み込みなど）は行の対応付けを行わずに差分なしとして返す
+    if df1.equals(df2):
+        return {
+            'df1': df1,
+            'df2': df2,
+            'df1_styles': [],
+            'df2_styles': [],
+            'diff_summary': pd.DataFrame()
+        }
     
     # Get common columns
-    common_cols = list(set(df1.columns) & set(df2.columns))
+    common_cols = df1.columns.intersection(df2.columns, sort=False).tolist()
+    # No.列かどうかは列ごとに一度だけ判定する
+    is_no_column = [_is_no_column(col) for col in common_cols]
+    n1, n2 = len(df1), len(df2)
+    # 共通列の切り出しは一度だけ行い、以降は行・列の位置で参照する
+    common1, common2 = df1[common_cols], df2[common_cols]
+    # 行アクセスのたびにSeriesを生成しないよう、共通列の値と欠損の有無を配列として一度だけ作成
+    values1 = common1.to_numpy(dtype=object)
+    values2 = common2.to_numpy(dtype=object)
+    present1, present2 = pd.notna(values1), pd.notna(values2)
+    
+    # Initialize style information (セルごとのスタイルコードを配列で保持)
+    df1_style_codes = np.zeros((n1, len(common_cols)), dtype=np.int8)
+    df2_style_codes = np.zeros((n2, len(common_cols)), dtype=np.int8)
     
     # Identify potential key columns
     key_columns = [col for col in common_cols if any(key in col.lower() 
@@ -214,314 +513,152 @@ def compare_dataframes(df1, df2):
         # If no key columns found, use the first column and additional columns for better matching
         key_columns = common_cols[:min(3, len(common_cols))]
     
-    def create_row_hash(row):
-        """Create a hash value for row matching based on key columns with improved type handling"""
-        values = []
-        
-        def is_no_column(col_name):
-            """No.列かどうかを判定"""
-            return col_name.lower().strip() in ['no', 'no.', '番号']
-        
-        def normalize_numeric(val):
-            """数値を正規化して文字列に変換"""
-            if pd.isna(val) or val is None:
-                return ''
-            try:
-                if isinstance(val, (int, np.integer)):
-                    return str(int(val))
-                elif isinstance(val, float):
-                    # 整数の場合は整数として扱う
-                    if val.is_integer():
-                        return str(int(val))
-                    # 小数の場合は固定精度で表現
-                    return f"{val:.6f}".rstrip('0').rstrip('.')
-                else:
-                    return str(val)
-            except (AttributeError, ValueError, TypeError):
-                return str(val)
-        
-        def normalize_string(val):
-            """文字列を正規化"""
-            if pd.isna(val) or val is None:
-                return ''
-            return str(val).strip().lower()
-        
-        # No.列以外のキー列を優先して処理
-        no_columns = []
-        other_key_columns = []
-        
-        for col in key_columns:
-            if is_no_column(col):
-                no_columns.append(col)
-            else:
-                other_key_columns.append(col)
-        
-        # No.列以外のキー列を処理
-        for col in other_key_columns:
-            try:
-                val = row[col]
-                if pd.api.types.is_numeric_dtype(type(val)):
-                    values.append(normalize_numeric(val))
-                else:
-                    values.append(normalize_string(val))
-            except Exception:
-                values.append('')
-        
-        # No.列を処理（行番号の自動更新を考慮）
-        for col in no_columns:
-            try:
-                val = row[col]
-                # No.列は参考情報として扱い、重みを小さくする
-                values.append(f"no_ref:{normalize_numeric(val)}")
-            except Exception:
-                values.append('')
-        
-        # キー列の重み付けを反映したハッシュ値を生成
-        weighted_values = []
-        for i, val in enumerate(values):
-            if val.startswith('no_ref:'):
-                # No.列は最も低い重みを設定
-                weight = 0.1
-            else:
-                # その他のキー列は順序に基づいて重み付け
-                weight = len(other_key_columns) - i if i < len(other_key_columns) else 0.5
-            weighted_values.append(f"{weight}:{val}")
-        
-        return '||'.join(weighted_values)
-    
     # Create hash values for both dataframes with error handling
     try:
-        df1['_row_hash'] = df1.apply(create_row_hash, axis=1)
-        df2['_row_hash'] = df2.apply(create_row_hash, axis=1)
+        row_hash1 = _row_hashes(df1, key_columns)
+        # 一部のセルだけ編集した場合などキー列が位置ごとに同じなら、df2のハッシュはdf1と同じになるため再計算しない
+        if df1[key_columns].equals(df2[key_columns]):
+            row_hash2 = row_hash1
+        else:
+            row_hash2 = _row_hashes(df2, key_columns)
     except Exception as e:
         # エラーが発生した場合は、インデックスをハッシュとして使用
-        df1['_row_hash'] = df1.index.astype(str)
-        df2['_row_hash'] = df2.index.astype(str)
-    
-    # Initialize tracking sets
-    matched_df1_indices = set()
-    matched_df2_indices = set()
+        row_hash1 = df1.index.astype(str)
+        row_hash2 = df2.index.astype(str)
     
     # First pass: Find exact matches using hash values
-    hash_map_df2 = {hash_val: idx for idx, hash_val in enumerate(df2['_row_hash'])}
-    
-    for idx1, hash_val in enumerate(df1['_row_hash']):
-        if hash_val in hash_map_df2:
-            idx2 = hash_map_df2[hash_val]
-            if idx2 not in matched_df2_indices:
-                matched_df1_indices.add(idx1)
-                matched_df2_indices.add(idx2)
-                
-                # Check for modifications in matched rows
-                row1, row2 = df1.iloc[idx1], df2.iloc[idx2]
-                for col in common_cols:
-                    val1 = str(row1[col]).strip() if pd.notna(row1[col]) else ''
-                    val2 = str(row2[col]).strip() if pd.notna(row2[col]) else ''
-                    
-                    # No.列の場合は特別な処理
-                    if col.lower().strip() in ['no', 'no.', '番号']:
-                        # No.列の変更は、他の列に変更がある場合のみ記録
-                        continue
-                    
-                    if val1 != val2:
-                        # 実際の変更として記録
-                        df1_styles.append({
-                            'field': col,
-                            'rowIndex': idx1,
-                            'cellClass': 'ag-cell-modified'
-                        })
-                        df2_styles.append({
-                            'field': col,
-                            'rowIndex': idx2,
-                            'cellClass': 'ag-cell-modified'
-                        })
-                        differences.append({
-                            'type': '変更',
-                            'column': col,
-                            'row_index_old': idx1,
-                            'row_index_new': idx2,
-                            'value_old': val1,
-                            'value_new': val2
-                        })
+    # (両方のハッシュをまとめて整数コード化して突き合わせる。同じハッシュが複数ある場合、
+    #  df2側は最後の行に、df1側は先頭の行だけを対応付ける)
+    hash_codes, hash_uniques = pd.factorize(np.concatenate([np.asarray(row_hash2), np.asarray(row_hash1)]))
+    last_rows2 = np.full(len(hash_uniques), -1, dtype=np.intp)
+    np.maximum.at(last_rows2, hash_codes[:n2], np.arange(n2, dtype=np.intp))
+    candidates2 = last_rows2[hash_codes[n2:]]
+    candidates1 = np.flatnonzero(candidates2 >= 0)
+    candidates2 = candidates2[candidates1]
+    first_claims = ~pd.Index(candidates2).duplicated(keep='first')
+    exact_pairs_df1 = candidates1[first_claims]
+    exact_pairs_df2 = candidates2[first_claims]
+    
+    # Initialize tracking masks (対応付け済みの行を行番号ごとのboolで管理)
+    matched_df1 = np.zeros(n1, dtype=bool)
+    matched_df2 = np.zeros(n2, dtype=bool)
+    matched_df1[exact_pairs_df1] = True
+    matched_df2[exact_pairs_df2] = True
+    
+    # Check for modifications in matched rows (一致行全体をまとめて比較)
+    # No.列の変更は、他の列に変更がある場合のみ記録するため比較対象から除外
+    compare_pos = np.flatnonzero(~np.asarray(is_no_column, dtype=bool))
+    compare_cols = [common_cols[pos] for pos in compare_pos]
+    changed = _changed_cells(common1.iloc[exact_pairs_df1, compare_pos], common2.iloc[exact_pairs_df2, compare_pos])
+    
+    # 実際の変更として記録（表示用の文字列は変更のある行だけ作成）
+    changed_rows = np.flatnonzero(changed.any(axis=1))
+    block1 = _normalize_cell_values(common1.iloc[exact_pairs_df1[changed_rows], compare_pos])
+    block2 = _normalize_cell_values(common2.iloc[exact_pairs_df2[changed_rows], compare_pos])
+    block_rows, modified_cols = np.nonzero(changed[changed_rows])
+    modified_rows = changed_rows[block_rows]
+    modified_style_cols = compare_pos[modified_cols]
+    df1_style_codes[exact_pairs_df1[modified_rows], modified_style_cols] = _STYLE_MODIFIED
+    df2_style_codes[exact_pairs_df2[modified_rows], modified_style_cols] = _STYLE_MODIFIED
+    
+    exact_changes = pd.DataFrame({
+        'type': '変更',
+        'column': np.asarray(compare_cols, dtype=object)[modified_cols],
+        'row_index_old': exact_pairs_df1[modified_rows],
+        'row_index_new': exact_pairs_df2[modified_rows],
+        'value_old': block1[block_rows, modified_cols],
+        'value_new': block2[block_rows, modified_cols]
+    })
     
     # Second pass: Handle remaining rows using similarity matching
-    def calculate_row_similarity(row1, row2):
-        """Calculate similarity between two rows with improved matching logic"""
-        matches = 0
-        total_weight = 0
-        no_column_differences = []  # No.列の差分を追跡
-        
-        def calculate_string_similarity(s1, s2):
-            """文字列の類似度を計算（レーベンシュタイン距離ベース）"""
-            if not s1 and not s2:  # 両方空の場合
-                return 1.0
-            if not s1 or not s2:  # どちらかが空の場合
-                return 0.0
-                
-            # 文字列を正規化
-            s1 = str(s1).strip().lower()
-            s2 = str(s2).strip().lower()
-            
-            if s1 == s2:
-                return 1.0
-                
-            # 簡易的なレーベンシュタイン距離の計算
-            len_s1, len_s2 = len(s1), len(s2)
-            if len_s1 < len_s2:
-                s1, s2 = s2, s1
-                len_s1, len_s2 = len_s2, len_s1
-            
-            # 文字の一致度を計算
-            matches = sum(1 for i in range(min(len_s1, len_s2)) if s1[i] == s2[i])
-            return matches / max(len_s1, len_s2)
-        
-        def calculate_numeric_similarity(v1, v2):
-            """数値の類似度を計算"""
-            try:
-                if pd.isna(v1) and pd.isna(v2):
-                    return 1.0
-                if pd.isna(v1) or pd.isna(v2):
-                    return 0.0
-                
-                n1 = float(v1)
-                n2 = float(v2)
-                
-                if n1 == n2:
-                    return 1.0
-                    
-                # 数値の差に基づく類似度
-                max_val = max(abs(n1), abs(n2))
-                if max_val == 0:
-                    return 1.0
-                    
-                diff_ratio = abs(n1 - n2) / max_val
-                return max(0, 1 - diff_ratio)
-            except (ValueError, TypeError):
-                return 0.0
-        
-        for col in common_cols:
-            # No.列の特別処理
-            is_no_col = col.lower().strip() in ['no', 'no.', '番号']
-            
-            # キー列により高い重みを設定（No.列は低い重みに）
-            if is_no_col:
-                weight = 0.1
-            else:
-                weight = 3.0 if col in key_columns[:2] else 2.0 if col in key_columns else 1.0
-            
-            total_weight += weight
-            val1 = row1[col]
-            val2 = row2[col]
-            
-            # No.列の差分を追跡
-            if is_no_col and val1 != val2:
-                no_column_differences.append((col, val1, val2))
-            
-            # 数値型の場合
-            if pd.api.types.is_numeric_dtype(type(val1)) or pd.api.types.is_numeric_dtype(type(val2)):
-                similarity = calculate_numeric_similarity(val1, val2)
-            else:
-                # 文字列型の場合
-                similarity = calculate_string_similarity(val1, val2)
-            
-            matches += weight * similarity
-        
-        return matches / total_weight if total_weight > 0 else 0
+    # 列ごとの重みは行の組み合わせに依存しないため事前に計算
+    column_weights = []
+    for col, no_column in zip(common_cols, is_no_column):
+        # キー列により高い重みを設定（No.列は低い重みに）
+        if no_column:
+            column_weights.append(0.1)
+        else:
+            column_weights.append(3.0 if col in key_columns[:2] else 2.0 if col in key_columns else 1.0)
+    total_weight = sum(column_weights)
     
     # Process unmatched rows with similarity matching
-    unmatched_df1 = [i for i in range(len(df1)) if i not in matched_df1_indices]
-    unmatched_df2 = [i for i in range(len(df2)) if i not in matched_df2_indices]
+    unmatched_df1 = np.flatnonzero(~matched_df1)
+    unmatched_df2 = np.flatnonzero(~matched_df2)
     
     similarity_threshold = 0.8
     
-    for idx1 in unmatched_df1:
-        best_match = None
-        best_similarity = similarity_threshold
-        row1 = df1.iloc[idx1]
-        
-        for idx2 in unmatched_df2:
-            row2 = df2.iloc[idx2]
-            similarity = calculate_row_similarity(row1, row2)
-            
-            if similarity > best_similarity:
-                best_similarity = similarity
-                best_match = idx2
-        
-        if best_match is not None:
-            # Found a similar row
-            matched_df1_indices.add(idx1)
-            matched_df2_indices.add(best_match)
-            
-            # Mark modified cells
-            row2 = df2.iloc[best_match]
-            for col in common_cols:
-                val1 = str(row1[col]).strip() if pd.notna(row1[col]) else ''
-                val2 = str(row2[col]).strip() if pd.notna(row2[col]) else ''
-                if val1 != val2:
-                    df1_styles.append({
-                        'field': col,
-                        'rowIndex': idx1,
-                        'cellClass': 'ag-cell-modified'
-                    })
-                    df2_styles.append({
-                        'field': col,
-                        'rowIndex': best_match,
-                        'cellClass': 'ag-cell-modified'
-                    })
-                    differences.append({
-                        'type': '変更',
-                        'column': col,
-                        'row_index_old': idx1,
-                        'row_index_new': best_match,
-                        'value_old': val1,
-                        'value_new': val2,
-                        'similarity': best_similarity
-                    })
-        else:
-            # No similar row found - this row was deleted
-            row = df1.iloc[idx1]
-            for col in common_cols:
-                if pd.notna(row[col]):
-                    df1_styles.append({
-                        'field': col,
-                        'rowIndex': idx1,
-                        'cellClass': 'ag-cell-deleted'
-                    })
-            differences.append({
-                'type': 'deleted',
-                'row_index': idx1,
-                'values': row[common_cols].to_dict()
-            })
+    # 未一致行の値を列ごとに整数コード化し、類似度は異なる値の組み合わせごとに一度だけ計算する
+    similarity_columns = [
+        _similarity_column(values1[unmatched_df1, col_pos], values2[unmatched_df2, col_pos])
+        for col_pos in range(len(common_cols))
+    ]
     
-    # Mark remaining unmatched rows in df2 as added
-    for idx2 in range(len(df2)):
-        if idx2 not in matched_df2_indices:
-            row = df2.iloc[idx2]
-            for col in common_cols:
-                if pd.notna(row[col]):
-                    df2_styles.append({
-                        'field': col,
-                        'rowIndex': idx2,
-                        'cellClass': 'ag-cell-added'
-                    })
-            differences.append({
-                'type': 'added',
-                'row_index': idx2,
-                'values': row[common_cols].to_dict()
-            })
+    # 未一致のdf1行×df2行の類似度行列をブロックごとに計算し、各行で最も類似度の高い行（同値なら先頭）を選ぶ
+    # (残りの列の類似度がすべて1でもしきい値を超えられない行は、その時点で以降の列の計算を打ち切る)
+    best_positions = np.zeros(len(unmatched_df1), dtype=np.intp)
+    best_similarities = np.zeros(len(unmatched_df1))
+    remaining_weights = total_weight - np.cumsum(column_weights)
+    if len(unmatched_df2) and total_weight > 0:
+        block = max(1, _SIMILARITY_BLOCK_SIZE // len(unmatched_df2))
+        for start in range(0, len(unmatched_df1), block):
+            positions = np.arange(start, min(start + block, len(unmatched_df1)))
+            matches = np.zeros((len(positions), len(unmatched_df2)))
+            for column, weight, remaining in zip(similarity_columns, column_weights, remaining_weights):
+                matches += weight * _similarity_scores(column, positions)
+                if 0 < remaining < similarity_threshold * total_weight:
+                    # 丸め誤差で境界の行を落とさないよう、わずかに余裕を持たせて判定
+                    reachable = (matches.max(axis=1) + remaining) / total_weight > similarity_threshold - 1e-9
+                    if not reachable.all():
+                        positions, matches = positions[reachable], matches[reachable]
+            similarities = matches / total_weight
+            best_positions[positions] = similarities.argmax(axis=1)
+            best_similarities[positions] = similarities[np.arange(len(positions)), best_positions[positions]]
+    
+    # しきい値を超えた行は類似行として対応付け、それ以外は削除された行とする
+    is_similar = best_similarities > similarity_threshold
+    similar_pairs_df1 = unmatched_df1[is_similar]
+    similar_pairs_df2 = unmatched_df2[best_positions[is_similar]]
+    similar_scores = best_similarities[is_similar]
+    deleted_df1_indices = unmatched_df1[~is_similar]
+    matched_df1[similar_pairs_df1] = True
+    matched_df2[similar_pairs_df2] = True
     
-    # Remove temporary hash columns
-    if '_row_hash' in df1_result.columns:
-        df1_result.drop('_row_hash', axis=1, inplace=True)
-    if '_row_hash' in df2_result.columns:
-        df2_result.drop('_row_hash', axis=1, inplace=True)
+    # 類似行として対応付けた行の変更セルをまとめて判定・マーク
+    similar_block1 = _normalize_cell_values(common1.iloc[similar_pairs_df1])
+    similar_block2 = _normalize_cell_values(common2.iloc[similar_pairs_df2])
+    similar_rows, similar_cols = np.nonzero(similar_block1 != similar_block2)
+    df1_style_codes[similar_pairs_df1[similar_rows], similar_cols] = _STYLE_MODIFIED
+    df2_style_codes[similar_pairs_df2[similar_rows], similar_cols] = _STYLE_MODIFIED
+    
+    similar_changes = pd.DataFrame({
+        'type': '変更',
+        'column': np.asarray(common_cols, dtype=object)[similar_cols],
+        'row_index_old': similar_pairs_df1[similar_rows],
+        'row_index_new': similar_pairs_df2[similar_rows],
+        'value_old': similar_block1[similar_rows, similar_cols],
+        'value_new': similar_block2[similar_rows, similar_cols],
+        'similarity': similar_scores[similar_rows]
+    })
+    
+    # 削除行の値が入っているセルをまとめてマーク
+    df1_style_codes[deleted_df1_indices] = np.where(
+        present1[deleted_df1_indices], _STYLE_DELETED, df1_style_codes[deleted_df1_indices])
+    deleted_changes = _row_changes('deleted', deleted_df1_indices, common1)
+    
+    # Mark remaining unmatched rows in df2 as added
+    added_mask = ~matched_df2
+    df2_style_codes[present2 & added_mask[:, None]] = _STYLE_ADDED
+    added_changes = _row_changes('added', np.flatnonzero(added_mask), common2)
     
-    # Create difference summary
-    diff_summary = pd.DataFrame(differences)
+    # Create difference summary (種類ごとに列単位で作成済みの差分を一度に結合)
+    diff_parts = [part for part in (exact_changes, similar_changes, deleted_changes, added_changes) if not part.empty]
+    diff_summary = pd.concat(diff_parts, ignore_index=True) if diff_parts else pd.DataFrame()
+    df1_styles = _styles_from_codes(df1_style_codes, common_cols)
+    df2_styles = _styles_from_codes(df2_style_codes, common_cols)
     
     return {
-        'df1': df1_result,
-        'df2': df2_result,
+        'df1': df1,
+        'df2': df2,
         'df1_styles': df1_styles,
         'df2_styles': df2_styles,
         'diff_summary': diff_summary
@@ -76,9 +76,10 @@ def main():
                         f.write(file2.getvalue())
                     
                     # Get workbook information using openpyxl
+                    # シート名だけが必要なため、セルやスタイルを展開しない読み取り専用モードで開く
                     try:
-                        wb1 = load_workbook(file1_path)
-                        wb2 = load_workbook(file2_path)
+                        wb1 = load_workbook(file1_path, read_only=True, data_only=True, keep_links=False)
+                        wb2 = load_workbook(file2_path, read_only=True, data_only=True, keep_links=False)
                         
                         # シート名の取得
                         sheets1 = wb1.sheetnames
@@ -4,7 +4,9 @@ import pandas as pd
 import io
 from datetime import datetime
 import inspect
-import traceback
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def get_excel_cell_reference(column_index, row_index):
@@ -58,25 +60,24 @@ def create_grid(df, cell_styles=None):
         # セルスタイリングの設定
         if cell_styles:
             try:
-                cell_style_jscode = JsCode("""
+                # 行番号・列名からクラス名を引ける表を事前に作成し、セルごとの処理は参照のみにする
+                cell_classes = {}
+                for style in cell_styles:
+                    cell_classes.setdefault(int(style['rowIndex']), {})[style['field']] = style['cellClass']
+
+                cell_class_jscode = JsCode("""
                 function(params) {
                     try {
-                        if (!params.data) return null;
-                        if (!params.column || !params.column.colId) return null;
-                        return {
-                            'backgroundColor': params.data._cellStyles ? 
-                                params.data._cellStyles[params.column.colId] : null
-                        };
+                        const rows = params.context ? params.context.cell_classes : null;
+                        if (!rows || !params.node || !params.colDef) return null;
+                        const row = rows[params.node.sourceRowIndex];
+                        return row ? (row[params.colDef.field] || null) : null;
                     } catch (e) {
                         console.error('セルスタイル適用エラー:', e);
                         return null;
                     }
                 }
                 """)
-
-                # グリッドオプションの設定
-                gb.configure_grid_options(getRowStyle=None,
-                                          getCellStyle=cell_style_jscode)
             except Exception as e:
                 st.error(f"スタイル設定中にエラーが発生しました: {str(e)}")
                 return st.dataframe(df)
@@ -85,7 +86,8 @@ def create_grid(df, cell_styles=None):
             grid_options = gb.build()
 
             if cell_styles:
-                grid_options['context'] = {'cell_styles': cell_styles}
+                grid_options['defaultColDef']['cellClass'] = cell_class_jscode
+                grid_options['context'] = {'cell_classes': cell_classes}
 
             # データ更新とグリッド初期化の非同期処理
             grid_options['onGridReady'] = JsCode('''
@@ -315,9 +317,7 @@ def export_comparison(comparison_results, sheets1, sheets2):
                         def format_values(values):
                             try:
                                 # デバッグ情報を先に出力
-                                st.write("デバッグ情報:")
-                                st.write(f"入力値の型: {type(values)}")
-                                st.write(f"入力値の内容: {values}")
+                                logger.debug("入力値の型: %s, 入力値の内容: %s", type(values), values)
 
                                 if isinstance(values, dict):
                                     # values が辞書の場合
@@ -325,7 +325,7 @@ def export_comparison(comparison_results, sheets1, sheets2):
                                         f"{k}: {v}" for k, v in values.items()
                                         if pd.notna(v)
                                     ])
-                                    st.write(f"処理結果: {result}")
+                                    logger.debug("処理結果: %s", result)
                                     return result
                                 elif hasattr(values,
                                              '__iter__') and not isinstance(
@@ -336,20 +336,17 @@ def export_comparison(comparison_results, sheets1, sheets2):
                                         f"{k}: {v}" for k, v in list(values)
                                         if pd.notna(v)
                                     ])  # dict_itemsをリスト化
-                                    st.write(f"処理結果: {result}")
+                                    logger.debug("処理結果: %s", result)
                                     return result
 
                                 result = str(values)
-                                st.write(f"処理結果: {result}")
+                                logger.debug("処理結果: %s", result)
                                 return result
 
                             except Exception as e:
                                 st.error(f"値のフォーマット中にエラー: {str(e)}")
-                                st.write("デバッグ情報:")
-                                st.write(f"エラー発生時の値の型: {type(values)}")
-                                st.write(f"エラー発生時の値の内容: {values}")
-                                st.write(
-                                    f"エラーのトレース情報: {traceback.format_exc()}")
+                                logger.debug("エラー発生時の値の型: %s, 値の内容: %s",
+                                             type(values), values, exc_info=True)
                                 return str(values)
 
                         try:
@@ -371,12 +368,8 @@ def export_comparison(comparison_results, sheets1, sheets2):
                             })
                         except Exception as e:
                             st.error(f"データ変更の処理中にエラーが発生しました: {str(e)}")
-                            st.write(f"Debug - エラーの詳細: {str(e)}")
-                            st.write(
-                                f"Debug - diff['values']の型: {type(diff['values'])}"
-                            )
-                            st.write(
-                                f"Debug - diff['values']の内容: {diff['values']}")
+                            logger.debug("diff['values']の型: %s, 内容: %s",
+                                         type(diff['values']), diff['values'], exc_info=True)
 
                     data_changes.append(change_info)
 